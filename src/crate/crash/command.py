@@ -24,12 +24,13 @@ crate cli
 can be used to query crate using SQL
 """
 from __future__ import print_function
-import inspect
 import json
 import logging
 import os
 import sys
 import select
+import threading
+from bisect import bisect_left
 
 _has_readline = False
 try:
@@ -38,20 +39,47 @@ try:
 except ImportError:
     _has_readline = False
 
+# libedit (e.g. on OS X) uses a different syntax to bind tab completion
+if _has_readline and readline.__doc__ and 'libedit' in readline.__doc__:
+    _READLINE_BIND = "bind ^I rl_complete"
+else:
+    _READLINE_BIND = "tab: complete"
+
 import atexit
 from appdirs import user_data_dir
 
 from cmd import Cmd
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
-from crate import client
-from crate.client.exceptions import ConnectionError, Error, Warning
-from crate.client.compat import raw_input
 from .tabulate import TableFormat, Line, DataRow, tabulate
 
+if sys.version_info[0] > 2:
+    raw_input = input
+
+# the crate client is slow to import and not needed for e.g. ``--help``,
+# it is imported once a CrateCmd is created, see ``_import_client``,
+# which also defines the ConnectionError, Error and Warning globals
+client = None
+
 
 MAX_HISTORY_LENGTH = 10000
 
+COMMENT_PREFIX = '--'
+
+# status messages printed after each statement
+_FMT_ROWS_AFFECTED_DUR = "{0} OK, {1} row{2} affected ({3:.3f} sec)"
+_FMT_ROWS_AFFECTED = "{0} OK, {1} row{2} affected"
+_FMT_ROWS_SELECTED_DUR = "SELECT {0} row{1} in set ({2:.3f} sec)"
+_FMT_ROWS_SELECTED = "SELECT {0} row{1} in set"
+_FMT_SUCCESS_DUR = "{0} OK ({1:.3f} sec)"
+_FMT_SUCCESS = "{0} OK"
+_FMT_EXCEPTION = "{0}: {1}"
+_FMT_ERROR_DUR = "{0} ERROR ({1:.3f} sec)"
+_FMT_ERROR = "{0} ERROR"
+_FMT_TRUNCATED = "WARNING: only the first {0} of {1} rows are displayed"
+# plural suffix, indexed by ``rowcount == 1``
+_PLURAL = ("s", "")
+
 
 crate_fmt = TableFormat(lineabove=Line("+", "-", "+", "+"),
                         linebelowheader=Line("+", "-", "+", "+"),
@@ -62,6 +90,44 @@ crate_fmt = TableFormat(lineabove=Line("+", "-", "+", "+"),
                         padding=1, with_header_hide=None)
 
 
+def _import_client():
+    global client, ConnectionError, Error, Warning
+    if client is None:
+        from crate import client
+        from crate.client.exceptions import ConnectionError, Error, Warning
+
+
+# a single encoder is reused for all fields instead of letting
+# json.dumps create a new one for every call
+_json_dumps = json.JSONEncoder(sort_keys=True, ensure_ascii=False).encode
+
+
+def _identity(field):
+    return field
+
+
+# field transformations for displaying, looked up by exact type;
+# bools are handled by ``CrateCmd._transform_field`` and fields of any
+# other type are displayed as they are
+_FIELD_DISPATCH = {
+    list: _json_dumps,
+    dict: _json_dumps,
+}
+_TRANSFORMED_TYPES = frozenset(_FIELD_DISPATCH) | frozenset([bool])
+
+
+_KEYWORDS = (
+    "table", "index", "from", "into", "where", "values", "and", "or",
+    "set", "with", "by", "using", "like",
+    "boolean", "integer", "string", "float", "double", "short", "long",
+    "byte", "timestamp", "ip", "object", "dynamic", "strict", "ignored",
+    "array", "blob", "primary key",
+    "analyzer", "extends", "tokenizer", "char_filters", "token_filters",
+    "number_of_replicas", "clustered",
+    "refresh", "alter",
+)
+
+
 class CrateCmd(Cmd):
     prompt = 'cr> '
     line_delimiter = ';'
@@ -70,22 +136,18 @@ class CrateCmd(Cmd):
     TRUE = u'TRUE'
     FALSE = u'FALSE'
 
-    keywords = [
-        "table", "index", "from", "into", "where", "values", "and", "or",
-        "set", "with", "by", "using", "like",
-        "boolean", "integer", "string", "float", "double", "short", "long",
-        "byte", "timestamp", "ip", "object", "dynamic", "strict", "ignored",
-        "array", "blob", "primary key",
-        "analyzer", "extends", "tokenizer", "char_filters", "token_filters",
-        "number_of_replicas", "clustered",
-        "refresh", "alter",
-    ]
-
-    def __init__(self, stdin=None, stdout=None, error_trace=False):
+    keywords = _KEYWORDS
+    # ``keywords`` and its sorted copy, built on first completion
+    _sorted_keywords = (None, ())
+
+    def __init__(self, stdin=None, stdout=None, error_trace=False,
+                 max_rows=None):
         Cmd.__init__(self, "tab", stdin, stdout)
+        _import_client()
         self.exit_code = 0
         self.partial_lines = []
         self.error_trace = error_trace
+        self.max_rows = max_rows
 
     def do_connect(self, server, error_trace=False):
         """
@@ -94,18 +156,8 @@ class CrateCmd(Cmd):
         """
         self.conn = client.connect(servers=server, error_trace=self.error_trace)
         self.cursor = self.conn.cursor()
-        results = []
-        failed = 0
-        for server in self.conn.client.active_servers:
-            try:
-                server_infos = self.conn.client.server_infos(server)
-            except ConnectionError as e:
-                failed += 1
-                results.append([server, None, False, e.message])
-            else:
-                results.append(
-                    server_infos + (True, "OK", )
-                )
+        results = self._server_infos(list(self.conn.client.active_servers))
+        failed = sum(1 for result in results if not result[2])
         self.pprint(
             results,
             ["server_url", "node_name", "connected", "message"])
@@ -114,9 +166,44 @@ class CrateCmd(Cmd):
         else:
             self.print_success("connect")
 
+    def _server_infos(self, servers):
+        """probe all servers concurrently, results keep the server order"""
+        results = [None] * len(servers)
+        errors = []
+
+        def probe(i, server):
+            try:
+                results[i] = (
+                    self.conn.client.server_infos(server) + (True, "OK", ))
+            except ConnectionError as e:
+                results[i] = [server, None, False, e.message]
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=probe, args=(i, server))
+                   for i, server in enumerate(servers)]
+        for thread in threads:
+            # don't keep the process alive on ctrl-c while probes hang
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join without a timeout can't be interrupted on python 2
+            while thread.is_alive():
+                thread.join(0.1)
+        if errors:
+            raise errors[0]
+        return results
+
     def execute_query(self, statement):
         if self.execute(statement):
-            self.pprint(self.cursor.fetchall())
+            if self.max_rows is None:
+                rows = self.cursor.fetchall()
+            else:
+                rows = self.cursor.fetchmany(self.max_rows)
+            self.pprint(rows)
+            rowcount = self.cursor.rowcount
+            if len(rows) < rowcount:
+                print(_FMT_TRUNCATED.format(len(rows), rowcount))
             self.print_rows_selected()
 
     def execute(self, statement):
@@ -129,19 +216,22 @@ class CrateCmd(Cmd):
                 'Use "connect <hostname:port>" to connect to a server first')
         except (Error, Warning) as e:
             self.exit_code = 1
-            if hasattr(e, 'message'):
-                print(e.message)
-            else:
-                print(e)
-            if self.error_trace and hasattr(e, "error_trace") and e.error_trace:
-                print(e.error_trace)
+            print(getattr(e, 'message', None) or e)
+            error_trace = getattr(e, 'error_trace', None)
+            if self.error_trace and error_trace:
+                print(error_trace)
 
         return False
 
     def pprint(self, rows, cols=None):
         if cols is None:
             cols = self.cols()
-        rows = [list(map(self._transform_field, row)) for row in rows]
+        transform = self._transform_field
+        # rows without any field to transform are passed through as they are
+        is_plain = _TRANSFORMED_TYPES.isdisjoint
+        rows = [row if is_plain(map(type, row))
+                else [transform(c) for c in row]
+                for row in rows]
         out = tabulate(rows, headers=cols, tablefmt=crate_fmt, floatfmt="",
                        missingval=self.NULL)
         try:
@@ -155,16 +245,18 @@ class CrateCmd(Cmd):
 
     def _transform_field(self, field):
         """transform field for displaying"""
-        if isinstance(field, bool):
+        if type(field) is bool:
             return self.TRUE if field else self.FALSE
-        elif isinstance(field, (list, dict)):
-            return json.dumps(field, sort_keys=True, ensure_ascii=False)
-        else:
-            return field
+        return (_FIELD_DISPATCH.get(type(field)) or _identity)(field)
 
     def cols(self):
         return [c[0] for c in self.cursor.description]
 
+    def _execute_command(self, command, statement, print_status):
+        """execute ``command statement`` and print its status on success"""
+        if self.execute(command + ' ' + statement):
+            print_status(command)
+
     def do_select(self, statement):
         """execute a SQL select statement
 
@@ -179,8 +271,7 @@ class CrateCmd(Cmd):
         E.g.:
             "insert into locations (name) values ('Algol')"
         """
-        if self.execute('insert ' + statement):
-            self.print_rows_affected("insert")
+        self._execute_command('insert', statement, self.print_rows_affected)
 
     def do_delete(self, statement):
         """execute a SQL delete statement
@@ -188,8 +279,7 @@ class CrateCmd(Cmd):
         E.g.:
             "delete from locations where name = 'Algol'"
         """
-        if self.execute('delete ' + statement):
-            self.print_rows_affected("delete")
+        self._execute_command('delete', statement, self.print_rows_affected)
 
     def do_update(self, statement):
         """execute a SQL update statement
@@ -197,8 +287,7 @@ class CrateCmd(Cmd):
         E.g.:
             "update from locations set name = 'newName' where name = 'Algol'"
         """
-        if self.execute('update ' + statement):
-            self.print_rows_affected("update")
+        self._execute_command('update', statement, self.print_rows_affected)
 
     def do_alter(self, statement):
         """execute a SQL ALTER statement
@@ -206,8 +295,7 @@ class CrateCmd(Cmd):
         E.g.:
             "alter table locations set (number_of_replicas=2)"
         """
-        if self.execute('alter ' + statement):
-            self.print_success("alter")
+        self._execute_command('alter', statement, self.print_success)
 
     def do_create(self, statement):
         """execute a SQL create statement
@@ -215,8 +303,7 @@ class CrateCmd(Cmd):
         E.g.:
             "create table locations (id integer, name string)"
         """
-        if self.execute('create ' + statement):
-            self.print_success("create")
+        self._execute_command('create', statement, self.print_success)
 
     def do_crate(self, statement):
         """alias for ``do_create``"""
@@ -228,8 +315,7 @@ class CrateCmd(Cmd):
         E.g.:
             "drop table locations"
         """
-        if self.execute('drop ' + statement):
-            self.print_success("drop")
+        self._execute_command('drop', statement, self.print_success)
 
     def do_copy(self, statement):
         """execute a SQL copy statement
@@ -237,8 +323,7 @@ class CrateCmd(Cmd):
         E.g.:
             "copy locations from 'path/to/import/data.json'"
         """
-        if self.execute('copy ' + statement):
-            self.print_rows_affected("copy")
+        self._execute_command('copy', statement, self.print_rows_affected)
 
     def do_refresh(self, statement):
         """execute a SQL refresh statement
@@ -246,8 +331,7 @@ class CrateCmd(Cmd):
         E.g.:
             "refresh table locations"
         """
-        if self.execute('refresh ' + statement):
-            self.print_success("refresh")
+        self._execute_command('refresh', statement, self.print_success)
 
     def do_set(self, statement):
         """execute a SQL set statement
@@ -255,8 +339,7 @@ class CrateCmd(Cmd):
         E.g.:
             "set global persistent collect_stats=true"
         """
-        if self.execute('set ' + statement):
-            self.print_success("set")
+        self._execute_command('set', statement, self.print_success)
 
     def do_reset(self, statement):
         """execute a SQL reset statement
@@ -264,8 +347,7 @@ class CrateCmd(Cmd):
         E.g.:
             "reset global persistent collect_stats"
         """
-        if self.execute('reset ' + statement):
-            self.print_success("reset")
+        self._execute_command('reset', statement, self.print_success)
 
     def do_exit(self, *args):
         """exit the shell"""
@@ -281,43 +363,48 @@ class CrateCmd(Cmd):
 
     def print_rows_affected(self, command):
         """print success status with rows affected and query duration"""
-        rowcount = self.cursor.rowcount
-        if self.cursor.duration > -1:
-            print("{0} OK, {1} row{2} affected ({3:.3f} sec)".format(
-                command.upper(), rowcount, "s"[rowcount == 1:],
-                float(self.cursor.duration) / 1000))
+        cursor = self.cursor
+        rowcount = cursor.rowcount
+        duration = cursor.duration
+        plural = _PLURAL[rowcount == 1]
+        if duration > -1:
+            print(_FMT_ROWS_AFFECTED_DUR.format(
+                command.upper(), rowcount, plural, float(duration) / 1000))
         else:
-            print("{0} OK, {1} row{2} affected".format(
-                command.upper(), rowcount, "s"[rowcount == 1:]))
+            print(_FMT_ROWS_AFFECTED.format(command.upper(), rowcount, plural))
 
     def print_rows_selected(self):
         """print count of rows in result set and query duration"""
-        rowcount = self.cursor.rowcount
-        if self.cursor.duration > -1:
-            print("SELECT {0} row{1} in set ({2:.3f} sec)".format(
-                rowcount, "s"[rowcount == 1:],
-                float(self.cursor.duration) / 1000))
+        cursor = self.cursor
+        rowcount = cursor.rowcount
+        duration = cursor.duration
+        plural = _PLURAL[rowcount == 1]
+        if duration > -1:
+            print(_FMT_ROWS_SELECTED_DUR.format(
+                rowcount, plural, float(duration) / 1000))
         else:
-            print("SELECT {0} row{1} in set".format(
-                rowcount, "s"[rowcount == 1:]))
+            print(_FMT_ROWS_SELECTED.format(rowcount, plural))
 
     def print_success(self, command):
         """print success status only and duration"""
-        if self.cursor.duration > -1:
-            print("{0} OK ({1:.3f} sec)".format(
-                command.upper(), float(self.cursor.duration) / 1000))
+        duration = self.cursor.duration
+        if duration > -1:
+            print(_FMT_SUCCESS_DUR.format(
+                command.upper(), float(duration) / 1000))
         else:
-            print("{0} OK".format(command.upper()))
+            print(_FMT_SUCCESS.format(command.upper()))
 
     def print_error(self, command, exception=None):
         if exception is not None:
-            print("{0}: {1}".format(
-                exception.__class__.__name__, exception.message))
-        if self.cursor.duration > -1:
-            print("{0} ERROR ({1:.3f} sec)".format(
-                command.upper(), float(self.cursor.duration) / 1000))
+            print(_FMT_EXCEPTION.format(
+                exception.__class__.__name__,
+                getattr(exception, 'message', None) or exception))
+        duration = self.cursor.duration
+        if duration > -1:
+            print(_FMT_ERROR_DUR.format(
+                command.upper(), float(duration) / 1000))
         else:
-            print("{0} ERROR".format(command.upper()))
+            print(_FMT_ERROR.format(command.upper()))
 
     def cmdloop(self, intro=None):
         """Repeatedly issue a prompt, accept input, parse an initial prefix
@@ -332,11 +419,7 @@ class CrateCmd(Cmd):
                 try:
                     self.old_completer = readline.get_completer()
                     readline.set_completer(self.complete)
-                    if getattr(readline, "__doc__") is not None \
-                            and 'libedit' in readline.__doc__:
-                        readline.parse_and_bind("bind ^I rl_complete")
-                    else:
-                        readline.parse_and_bind("tab: complete")
+                    readline.parse_and_bind(_READLINE_BIND)
                 except ImportError:
                     pass
         try:
@@ -345,7 +428,11 @@ class CrateCmd(Cmd):
             if self.intro:
                 self.stdout.write(str(self.intro) + "\n")
             stop = None
-            prompt = self.prompt
+            delim = self.line_delimiter
+            main_prompt = self.prompt
+            multi_line_prompt = self.multi_line_prompt
+            partial_lines = self.partial_lines
+            prompt = main_prompt
             while not stop:
                 if self.cmdqueue:
                     line = self.cmdqueue.pop(0)
@@ -363,17 +450,16 @@ class CrateCmd(Cmd):
                             line = 'EOF'
                         else:
                             line = line.rstrip('\r\n')
-                    if (line or self.partial_lines) and line != 'EOF':
-                        if line[-1:] != self.line_delimiter:
-                            self.partial_lines.append(line)
-                            prompt = self.multi_line_prompt
+                    if (line or partial_lines) and line != 'EOF':
+                        if not line.endswith(delim):
+                            partial_lines.append(line)
+                            prompt = multi_line_prompt
                         else:
-                            self.partial_lines.append(
-                                line.rstrip(self.line_delimiter))
-                            line = " ".join(self.partial_lines)
-                            self.partial_lines = []
-                            prompt = self.prompt
-                if not self.partial_lines or line == 'EOF':
+                            partial_lines.append(line.rstrip(delim))
+                            line = " ".join(partial_lines)
+                            del partial_lines[:]
+                            prompt = main_prompt
+                if not partial_lines or line == 'EOF':
                     line = self.precmd(line)
                     stop = self.onecmd(line)
                     stop = self.postcmd(stop, line)
@@ -382,19 +468,47 @@ class CrateCmd(Cmd):
             if self.use_rawinput and self.completekey and _has_readline:
                 readline.set_completer(self.old_completer)
 
+    def onecmd(self, line):
+        """Dispatch known commands with a single dict lookup and fall back
+        to ``Cmd.onecmd`` for anything else, e.g. ``?`` or ``!``.
+
+        """
+        cmd, _, arg = line.strip().partition(' ')
+        name = self._handlers.get(cmd)
+        if name is None:
+            return Cmd.onecmd(self, line)
+        self.lastcmd = '' if cmd == 'EOF' else line
+        return getattr(self, name)(arg.lstrip())
+
     def default(self, line):
-        if line.lstrip().startswith('--'):
+        if line.lstrip().startswith(COMMENT_PREFIX):
             return  # ignore comments
         Cmd.default(self, line)
 
+    def _get_sorted_keywords(self):
+        """sorted keywords so that completion can bisect to the matching
+        range, sorted again only if ``keywords`` is replaced"""
+        keywords, sorted_keywords = self._sorted_keywords
+        if keywords is not self.keywords:
+            sorted_keywords = tuple(sorted(self.keywords))
+            self._sorted_keywords = (self.keywords, sorted_keywords)
+        return sorted_keywords
+
     def completedefault(self, text, line, begidx, endidx):
         """Method called to complete an input line when no command-specific
         complete_*() method is available.
 
         """
-        mline = line.split(' ')[-1]
+        mline = line.rpartition(' ')[2]
         offs = len(mline) - len(text)
-        return [s[offs:] for s in self.keywords if s.startswith(mline)]
+        keywords = self._get_sorted_keywords()
+        completions = []
+        for i in range(bisect_left(keywords, mline), len(keywords)):
+            s = keywords[i]
+            if not s.startswith(mline):
+                break
+            completions.append(s[offs:])
+        return completions
 
     def emptyline(self):
         """Called when an empty line is entered in response to the prompt.
@@ -402,12 +516,16 @@ class CrateCmd(Cmd):
         pass
 
 # uppercase commands
-for name, attr in inspect.getmembers(
-        CrateCmd,
-        lambda attr: inspect.ismethod(attr) or inspect.isfunction(attr)):
+# dir() also covers inherited commands like ``do_help``
+CrateCmd._handlers = {}
+for name in dir(CrateCmd):
     if name.startswith("do_"):
-        cmd_name = name.split("do_")[-1]
-        setattr(CrateCmd, "do_{0}".format(cmd_name.upper()), attr)
+        attr = getattr(CrateCmd, name)
+        cmd_name = name[3:]
+        setattr(CrateCmd, "do_" + cmd_name.upper(), attr)
+        # map to the method name so that overrides are respected
+        CrateCmd._handlers[cmd_name] = name
+        CrateCmd._handlers[cmd_name.upper()] = name
 
 
 USER_DATA_DIR = user_data_dir("Crate", "Crate")
@@ -415,7 +533,23 @@ HISTORY_FILE_NAME = 'crash_history'
 HISTORY_PATH = os.path.join(USER_DATA_DIR, HISTORY_FILE_NAME)
 
 
-def parse_args():
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(
+            "must be a positive integer: {0}".format(value))
+    return number
+
+
+_parser = None
+
+
+def _get_parser():
+    """Create the argument parser once and reuse it on later calls
+    """
+    global _parser
+    if _parser is not None:
+        return _parser
     parser = ArgumentParser(description='crate shell')
     parser.add_argument('-v', '--verbose', action='count',
                         dest='verbose', default=0,
@@ -427,37 +561,66 @@ def parse_args():
                         help='execute sql statement')
     parser.add_argument('--hosts', type=str, nargs='*',
                         help='the crate hosts to connect to', metavar='HOST')
-    args = parser.parse_args()
-    return args
+    parser.add_argument('--max-rows', type=_positive_int, dest='max_rows',
+                        help='maximum number of rows to display',
+                        metavar='N')
+    _parser = parser
+    return parser
 
 
-def get_stdin():
-    """Get data from stdin, if any
+def parse_args():
+    return _get_parser().parse_args()
+
+
+def _stdin_lines():
+    """Yield the lines available on stdin without blocking on a terminal
+    or on a pipe that is used interactively
     """
+    if os.name != 'posix':
+        # select.select on sys.stdin doesn't work on windows,
+        # so redirected input is read until EOF
+        if not sys.stdin.isatty():
+            for line in sys.stdin.read().splitlines():
+                yield line
+        return
     # use select.select to check if input is available
     # otherwise sys.stdin would block
+    if sys.stdin not in select.select([sys.stdin], [], [], 0)[0]:
+        return
+    if not sys.stdin.isatty():
+        # piped or redirected input is read with a single call
+        for line in sys.stdin.read().splitlines():
+            yield line
+        return
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        yield line
+        if sys.stdin not in select.select([sys.stdin], [], [], 0)[0]:
+            break
+
+
+def get_stdin():
+    """Get data from stdin, if any
+    """
     partial_lines = []
     delim = CrateCmd.line_delimiter
-    while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-        line = sys.stdin.readline()
-        if line:
-            line = line.strip()
-            if line.startswith('--'):
-                continue
-            if line.endswith(delim):
-                line = line.rstrip(delim)
-                if partial_lines:
-                    yield ' '.join(partial_lines + [line])
-                    partial_lines = []
-                else:
-                    yield line
-            else:
-                partial_lines.append(line)
-        else:
+    for line in _stdin_lines():
+        line = line.strip()
+        if line.startswith(COMMENT_PREFIX):
+            continue
+        if line.endswith(delim):
+            line = line.rstrip(delim)
             if partial_lines:
                 yield ' '.join(partial_lines + [line])
-            break
-    return
+                partial_lines = []
+            else:
+                yield line
+        else:
+            partial_lines.append(line)
+    if partial_lines:
+        yield ' '.join(partial_lines + [''])
 
 
 def main():
@@ -486,13 +649,10 @@ def main():
         stream=sys.stdout
     )
 
-    cmd = CrateCmd(error_trace=error_trace)
+    cmd = CrateCmd(error_trace=error_trace, max_rows=args.max_rows)
     cmd.do_connect(args.hosts)
-    # select.select on sys.stdin doesn't work on windows
-    # so currently there is no pipe support
     done = False
-    if os.name == 'posix':
-        stdin_data = get_stdin()
+    stdin_data = get_stdin()
     if args.command:
         for single_cmd in args.command.split(CrateCmd.line_delimiter):
             cmd.onecmd(single_cmd)
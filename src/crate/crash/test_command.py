@@ -4,9 +4,11 @@ from unittest import TestCase
 from six import PY2, StringIO
 import tempfile
 from io import TextIOWrapper
-from mock import patch
+from mock import patch, Mock
 
-from .command import CrateCmd, main, get_stdin
+from crate.client.exceptions import ConnectionError, Error
+
+from .command import CrateCmd, main, get_stdin, parse_args, _get_parser
 
 
 def fake_stdin(data):
@@ -145,6 +147,170 @@ class CommandTest(TestCase):
                     "with (number_of_replicas=0)")
         self.assertEqual(stmt, expected)
 
+    def test_cols_follow_cursor_description(self):
+        """Column headers are taken from the cursor on every execution
+
+        Re-running the same statement may return different columns,
+        e.g. ``select *`` after a column was added.
+        """
+        command = CrateCmd()
+        command.cursor = Mock(rowcount=1, duration=-1,
+                              description=[('a', None)])
+        command.cursor.fetchall.return_value = [[1]]
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.execute_query('select * from t')
+            command.cursor.description = [('a', None), ('b', None)]
+            command.cursor.fetchall.return_value = [[1, 2]]
+            command.execute_query('select * from t')
+            self.assertTrue('| a | b |' in output.getvalue())
+
+    def test_cmdloop_multiline(self):
+        """Lines are joined until one ends with the delimiter"""
+        stdin = StringIO(u"select\n  1 from t;;\nselect 2;\n")
+        command = CrateCmd(stdin=stdin, stdout=StringIO())
+        command.use_rawinput = False
+        with patch.object(command, 'onecmd',
+                          side_effect=lambda line: line == 'EOF') as m:
+            command.cmdloop()
+        self.assertEqual([u"select   1 from t", u"select 2", u"EOF"],
+                         [c[0][0] for c in m.call_args_list])
+
+    def test_max_rows(self):
+        """Only max_rows rows are displayed followed by a warning"""
+        command = CrateCmd(max_rows=2)
+        command.cursor = Mock(rowcount=3, duration=-1,
+                              description=[('x', None)])
+        command.cursor.fetchmany.return_value = [[1], [2]]
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.execute_query('select x from t')
+            output = output.getvalue()
+        command.cursor.fetchmany.assert_called_once_with(2)
+        self.assertTrue(
+            'WARNING: only the first 2 of 3 rows are displayed' in output)
+        self.assertTrue('SELECT 3 rows in set' in output)
+
+    def test_onecmd_dispatch(self):
+        """Commands are dispatched in lower and upper case"""
+        command = CrateCmd()
+        with patch.object(command, 'execute_query') as execute_query:
+            command.onecmd('select 1 from t')
+            command.onecmd('  SELECT  2 from t')
+        self.assertEqual([u'select 1 from t', u'select 2 from t'],
+                         [c[0][0] for c in execute_query.call_args_list])
+
+    @patch('sys.stdin', fake_stdin('\n'.join(["-- create the table",
+                                              "create table test (d string);",
+                                              "  -- and fill it",
+                                              "insert into test (d)",
+                                              "values ('a');",
+                                              "select * from test;"])))
+    def test_stdin_multiple_statements(self):
+        """Test pass multiple statements and comments via stdin"""
+        self.assertEqual(["create table test (d string)",
+                          "insert into test (d) values ('a')",
+                          "select * from test"],
+                         list(get_stdin()))
+
+    def test_execute_error_message(self):
+        """Errors print their message, or the error itself without one"""
+        command = CrateCmd()
+        command.cursor = Mock(duration=-1)
+        command.cursor.execute.side_effect = Error('boom')
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            self.assertFalse(command.execute('select 1'))
+            command.print_error('select', ValueError('invalid'))
+            self.assertEqual('boom\nValueError: invalid\nSELECT ERROR\n',
+                             output.getvalue())
+        self.assertEqual(1, command.exit_code)
+
+    def test_execute_unexpected_error(self):
+        """Errors not raised by the client are not masked"""
+        command = CrateCmd()
+        command.cursor = Mock()
+        command.cursor.execute.side_effect = ValueError('unexpected')
+        self.assertRaises(ValueError, command.execute, 'select 1')
+
+    def test_connect_probes_servers_in_order(self):
+        """Servers are listed in the given order, failed ones included"""
+        def server_infos(server):
+            if server == 'http://b:4200':
+                raise ConnectionError('Server not available')
+            return server, server[7]
+
+        command = CrateCmd()
+        with patch('crate.crash.command.client') as client:
+            conn = client.connect.return_value
+            conn.client.active_servers = [
+                'http://a:4200', 'http://b:4200', 'http://c:4200']
+            conn.client.server_infos.side_effect = server_infos
+            conn.cursor.return_value = Mock(duration=-1)
+            with patch('sys.stdout', new_callable=StringIO) as output:
+                command.do_connect(['a:4200', 'b:4200', 'c:4200'])
+                output = output.getvalue()
+        lines = output.splitlines()
+        self.assertTrue(lines[3].startswith('| http://a:4200 | a '))
+        self.assertTrue(lines[4].startswith('| http://b:4200 | NULL '))
+        self.assertTrue(lines[5].startswith('| http://c:4200 | c '))
+        self.assertEqual('CONNECT OK', lines[-1])
+
+    def test_print_status(self):
+        """Status messages with and without duration"""
+        command = CrateCmd()
+        command.cursor = Mock(rowcount=1, duration=1234)
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.print_rows_affected('insert')
+            command.print_rows_selected()
+            command.print_success('create')
+            command.cursor = Mock(rowcount=2, duration=-1)
+            command.print_rows_affected('insert')
+            command.print_rows_selected()
+            command.print_error('create')
+            self.assertEqual(["INSERT OK, 1 row affected (1.234 sec)",
+                              "SELECT 1 row in set (1.234 sec)",
+                              "CREATE OK (1.234 sec)",
+                              "INSERT OK, 2 rows affected",
+                              "SELECT 2 rows in set",
+                              "CREATE ERROR"],
+                             output.getvalue().splitlines())
+
+    def test_parse_args_reuses_parser(self):
+        """The parser is created once and parses the current sys.argv"""
+        orig_argv = sys.argv[:]
+        try:
+            sys.argv = ['testcrash', '--max-rows', '10']
+            self.assertEqual(10, parse_args().max_rows)
+            sys.argv = ['testcrash', '-c', 'select 1']
+            args = parse_args()
+            self.assertEqual('select 1', args.command)
+            self.assertEqual(None, args.max_rows)
+            self.assertTrue(_get_parser() is _get_parser())
+        finally:
+            sys.argv = orig_argv
+
+    def test_max_rows_must_be_positive(self):
+        """--max-rows rejects zero and negative values"""
+        orig_argv = sys.argv[:]
+        try:
+            for value in ('0', '-3', 'x'):
+                sys.argv = ['testcrash', '--max-rows', value]
+                with patch('sys.stderr', new_callable=StringIO):
+                    self.assertRaises(SystemExit, parse_args)
+        finally:
+            sys.argv = orig_argv
+
+    def test_onecmd_dispatch_override(self):
+        """Overridden commands are dispatched to the override"""
+        class SubCmd(CrateCmd):
+            def do_select(self, statement):
+                self.selected = statement
+
+        command = SubCmd()
+        command.onecmd('SELECT 1 from t')
+        self.assertEqual('1 from t', command.selected)
+        with patch.object(command, 'do_insert') as do_insert:
+            command.onecmd('insert into t (x) values (1)')
+        do_insert.assert_called_once_with('into t (x) values (1)')
+
     def test_tabulate_null_int_column(self):
         """
         Create a column with a non-string value and NULL.
@@ -202,6 +368,22 @@ class CommandTest(TestCase):
             command.pprint([[user]], ['user'])
             self.assertEqual(expected, output.getvalue())
 
+    def test_rendering_nested_object(self):
+        """Test rendering a nested object
+
+        Keys are sorted and non-ascii characters are not escaped.
+        """
+        obj = {'b': {'d': None, 'c': u'\xf6'}, 'a': [1, 2]}
+        expected = u"\n".join([u'+-------------------------------------------+',
+                               u'| obj                                       |',
+                               u'+-------------------------------------------+',
+                               u'| {"a": [1, 2], "b": {"c": "\xf6", "d": null}} |',
+                               u'+-------------------------------------------+\n'])
+        command = CrateCmd()
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.pprint([[obj]], ['obj'])
+            self.assertEqual(expected, output.getvalue())
+
     def test_rendering_array(self):
         """Test rendering an array"""
         names = ['Arthur', 'Ford']
@@ -215,6 +397,23 @@ class CommandTest(TestCase):
             command.pprint([[names]], ['names'])
             self.assertEqual(expected, output.getvalue())
 
+    def test_rendering_boolean(self):
+        """Test rendering booleans"""
+        expected = "\n".join(['+-------+',
+                              '| flag  |',
+                              '+-------+',
+                              '| TRUE  |',
+                              '| FALSE |',
+                              '+-------+\n'])
+        command = CrateCmd()
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.pprint([[True], [False]], ['flag'])
+            self.assertEqual(expected, output.getvalue())
+        command.TRUE, command.FALSE = u'yes', u'no'
+        with patch('sys.stdout', new_callable=StringIO) as output:
+            command.pprint([[True, False]], ['a', 'b'])
+            self.assertTrue(u'| yes | no |' in output.getvalue())
+
     def test_rendering_float(self):
         """Test rendering an array"""
         expected = "\n".join(['+---------------+',
@@ -228,3 +427,18 @@ class CommandTest(TestCase):
             command.pprint([[3.1415926535], [42.0]], ['number'])
             self.assertEqual(expected, output.getvalue())
 
+    def test_completedefault(self):
+        """Test completion of keywords by prefix"""
+        command = CrateCmd()
+        self.assertEqual(
+            ['table', 'timestamp', 'token_filters', 'tokenizer'],
+            command.completedefault('t', 'select * from t', 14, 15))
+        self.assertEqual(
+            ['tokenizer'],
+            command.completedefault('tokeni', 'with tokeni', 5, 11))
+        self.assertEqual(
+            [], command.completedefault('zz', 'select zz', 7, 9))
+        command.keywords = ('zz_top', 'zzz')
+        self.assertEqual(
+            ['zz_top', 'zzz'],
+            command.completedefault('zz', 'select zz', 7, 9))